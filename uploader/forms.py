@@ -3,6 +3,9 @@ from django.core.exceptions import ValidationError
 
 
 MAX_FILE_SIZE_BYTES = 5 * 1024 * 1024
+# Room for the multipart boundaries, part headers and the other form fields.
+MAX_UPLOAD_REQUEST_BYTES = MAX_FILE_SIZE_BYTES + 64 * 1024
+FILE_TOO_LARGE_MESSAGE = "File size must be less than 5MB."
 
 
 class VCFUploadForm(forms.Form):
@@ -15,12 +18,22 @@ class VCFUploadForm(forms.Form):
         error_messages={"required": "Please select a .vcf file to upload."}
     )
 
+    def __init__(self, *args, upload_too_large=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_too_large = upload_too_large
+        if upload_too_large:
+            # The file part was discarded unread; report its size, not its absence.
+            self.fields["vcf_file"].required = False
+
     def clean_vcf_file(self):
+        if self.upload_too_large:
+            raise ValidationError(FILE_TOO_LARGE_MESSAGE)
+
         uploaded_file = self.cleaned_data["vcf_file"]
         if not uploaded_file.name.lower().endswith(".vcf"):
             raise ValidationError("File extension must be .vcf.")
 
         if uploaded_file.size >= MAX_FILE_SIZE_BYTES:
-            raise ValidationError("File size must be less than 5MB.")
+            raise ValidationError(FILE_TOO_LARGE_MESSAGE)
 
         return uploaded_file
@@ -0,0 +1,19 @@
+from time import perf_counter
+
+
+class ProcessingTimeMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request._processing_started_at = perf_counter()
+        response = self.get_response(request)
+        response["X-Processing-Time-ms"] = str(processing_time_ms(request))
+        return response
+
+
+def processing_time_ms(request) -> int | None:
+    started_at = getattr(request, "_processing_started_at", None)
+    if started_at is None:
+        return None
+    return int((perf_counter() - started_at) * 1000)
@@ -1,8 +1,27 @@
+import functools
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
 
 
 FALLBACK_EXPLANATION = "LLM explanation unavailable"
 DEFAULT_MODEL = "gemini-1.5-flash"
+GEMINI_TIMEOUT_SECONDS = 30
+EXPLANATION_TTL_SECONDS = 10 * 60
+
+# Explanations are generated off the request path. Pending and finished
+# results live in the Django cache so any worker sharing it can answer a poll.
+_EXPLANATION_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gemini")
+
+
+@functools.lru_cache(maxsize=4)
+def _get_model(api_key: str, model_name: str):
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
 
 
 def build_gemini_prompt(gene: str, drug: str, phenotype: str, risk: str, rsids: list[str]) -> str:
@@ -19,20 +38,54 @@ def generate_gemini_explanation(gene: str, drug: str, phenotype: str, risk: str,
     if not api_key:
         return FALLBACK_EXPLANATION
 
-    try:
-        import google.generativeai as genai
-    except ImportError:
-        return FALLBACK_EXPLANATION
-
     prompt = build_gemini_prompt(gene=gene, drug=drug, phenotype=phenotype, risk=risk, rsids=rsids)
 
     try:
         model_name = os.getenv("GEMINI_MODEL", DEFAULT_MODEL)
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
+        model = _get_model(api_key, model_name)
+        response = model.generate_content(
+            prompt,
+            request_options={"timeout": GEMINI_TIMEOUT_SECONDS},
+        )
         text = getattr(response, "text", "") or ""
         cleaned = text.strip()
         return cleaned if cleaned else FALLBACK_EXPLANATION
     except Exception:
         return FALLBACK_EXPLANATION
+
+
+def _explanation_cache_key(task_id: str) -> str:
+    return f"gemini-explanation:{task_id}"
+
+
+def _store_gemini_explanation(task_id: str, **explanation_args) -> None:
+    explanation = generate_gemini_explanation(**explanation_args)
+    cache.set(_explanation_cache_key(task_id), {"explanation": explanation}, EXPLANATION_TTL_SECONDS)
+
+
+def submit_gemini_explanation(gene: str, drug: str, phenotype: str, risk: str, rsids: list[str]) -> str | None:
+    if not os.getenv("GEMINI_API_KEY"):
+        return None
+
+    task_id = uuid.uuid4().hex
+    cache.set(_explanation_cache_key(task_id), {"explanation": None}, EXPLANATION_TTL_SECONDS)
+    _EXPLANATION_EXECUTOR.submit(
+        _store_gemini_explanation,
+        task_id,
+        gene=gene,
+        drug=drug,
+        phenotype=phenotype,
+        risk=risk,
+        rsids=list(rsids),
+    )
+    return task_id
+
+
+def poll_gemini_explanation(task_id: str) -> str | None:
+    entry = cache.get(_explanation_cache_key(task_id))
+    if entry is None:
+        raise KeyError(task_id)
+    if entry["explanation"] is None:
+        return None
+    cache.delete(_explanation_cache_key(task_id))
+    return entry["explanation"]
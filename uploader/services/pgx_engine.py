@@ -1,9 +1,23 @@
 import re
+from collections.abc import Iterable
 from dataclasses import dataclass
 from pathlib import Path
 
 
 SUPPORTED_GENES = ("CYP2D6", "CYP2C19", "CYP2C9")
+GENE_FIELDS = ("GENE", "SYMBOL", "GENE_NAME", "HGNC")
+
+# VCF lines are parsed as raw bytes; only the values we keep are decoded.
+_SUPPORTED_GENE_BYTES = {gene.encode("ascii"): gene for gene in SUPPORTED_GENES}
+_SAMPLE_ID_RE = re.compile(rb"ID=([^,>]+)")
+_GENE_FIELD_KEYS = tuple(field.encode("ascii") for field in GENE_FIELDS)
+_SINGLE_GENE_NAME_RES = {
+    gene: re.compile(re.escape(gene_bytes), re.IGNORECASE)
+    for gene_bytes, gene in _SUPPORTED_GENE_BYTES.items()
+}
+_STAR_RE = re.compile(rb"\*[0-9A-Za-z]+(?:x\d+)?", re.IGNORECASE)
+_RSID_RE = re.compile(rb"\brs\d+\b")
+_STAR_SORT_RE = re.compile(r"\*(\d+)(.*)")
 
 
 class UnsupportedDrugError(ValueError):
@@ -16,6 +30,27 @@ class RuleDecision:
     recommendation: str
 
 
+@dataclass(slots=True)
+class AnalysisResult:
+    patient_id: str
+    drug: str
+    gene: str
+    diplotype: str
+    phenotype: str
+    risk: str
+    recommendation: str
+    severity: str
+    confidence_score: float
+    rsids: list[str]
+    parsed_genes: dict
+    vcf_parsing_success: bool
+    gene_detected: bool
+    rule_applied: bool
+    processing_time_ms: int | None = None
+    explanation: str | None = None
+    explanation_task_id: str | None = None
+
+
 PHENOTYPE_TABLE = {
     "CYP2D6": {
         "*1/*1": "NM",
@@ -98,91 +133,126 @@ SEVERITY_BY_RISK = {
 }
 
 
-def _extract_patient_id(lines: list[str], fallback_name: str) -> str:
-    for line in lines:
-        if line.startswith("##SAMPLE="):
-            match = re.search(r"ID=([^,>]+)", line)
-            if match:
-                return match.group(1).strip()
-    for line in lines:
-        if line.startswith("#CHROM"):
-            parts = line.split("\t")
-            if len(parts) > 9 and parts[9].strip():
-                return parts[9].strip()
-    return fallback_name
-
-
-def _extract_gene(text: str) -> str | None:
-    upper_text = text.upper()
-    for field in ("GENE", "SYMBOL", "GENE_NAME", "HGNC"):
-        match = re.search(rf"{field}=([^;]+)", upper_text)
+_PHENOTYPE_LOOKUP = {
+    (gene, diplotype): phenotype
+    for gene, diplotypes in PHENOTYPE_TABLE.items()
+    for diplotype, phenotype in diplotypes.items()
+}
+
+_DRUG_DECISION = {
+    (drug, phenotype): (decision.risk, decision.recommendation, SEVERITY_BY_RISK[decision.risk])
+    for drug, rule_config in CPIC_RULES.items()
+    for phenotype, decision in rule_config["phenotypes"].items()
+}
+
+
+def _extract_header_patient_id(line: bytes) -> str | None:
+    if line.startswith(b"##SAMPLE="):
+        match = _SAMPLE_ID_RE.search(line)
         if match:
-            raw_value = match.group(1).split(",")[0].strip()
-            if raw_value in SUPPORTED_GENES:
-                return raw_value
-    for gene in SUPPORTED_GENES:
-        if gene in upper_text:
-            return gene
+            return match.group(1).strip().decode("utf-8", "replace")
+    elif line.startswith(b"#CHROM"):
+        parts = line.split(b"\t")
+        if len(parts) > 9 and parts[9].strip():
+            return parts[9].strip().decode("utf-8", "replace")
     return None
 
 
-def _extract_stars(text: str) -> list[str]:
-    found = re.findall(r"\*[0-9A-Za-z]+(?:x\d+)?", text, flags=re.IGNORECASE)
-    normalized = []
-    for star in found:
-        clean_star = star.upper()
-        if clean_star not in normalized:
-            normalized.append(clean_star)
-    return normalized
+def _parse_info(info: bytes) -> dict[bytes, bytes]:
+    info_pairs = {}
+    for token in info.split(b";"):
+        key, separator, value = token.partition(b"=")
+        if separator:
+            info_pairs.setdefault(key.upper(), value)
+    return info_pairs
+
+
+def _extract_gene(info: bytes) -> str | None:
+    info_pairs = _parse_info(info)
+    for key in _GENE_FIELD_KEYS:
+        if key in info_pairs:
+            raw_value = info_pairs[key].split(b",")[0].strip().upper()
+            if raw_value in _SUPPORTED_GENE_BYTES:
+                return _SUPPORTED_GENE_BYTES[raw_value]
+    for gene, gene_re in _SINGLE_GENE_NAME_RES.items():
+        if gene_re.search(info):
+            return gene
+    return None
 
 
-def _extract_rsid(line: str, id_column: str) -> str | None:
-    if id_column.startswith("rs"):
-        return id_column
-    match = re.search(r"\brs\d+\b", line, flags=re.IGNORECASE)
+def _extract_rsid(info: bytes, id_column: bytes) -> str | None:
+    if id_column.startswith(b"rs"):
+        return id_column.decode("utf-8", "replace")
+    match = _RSID_RE.search(id_column.lower()) or _RSID_RE.search(info.lower())
     if match:
-        return match.group(0).lower()
+        return match.group(0).decode("ascii")
     return None
 
 
-def parse_vcf(vcf_text: str, filename: str) -> dict:
-    parsed_genes: dict[str, dict[str, list[str]]] = {}
-    lines = [line.rstrip("\n") for line in vcf_text.splitlines()]
-    patient_id = _extract_patient_id(lines, Path(filename).stem or "Unknown")
-
-    for line in lines:
-        if not line or line.startswith("#"):
+def parse_vcf(vcf_lines: Iterable[bytes], filename: str, required_gene: str | None = None) -> dict:
+    # Stars and rsIDs are collected into dicts used as insertion-ordered sets
+    # and only turned into lists once parsing is done.
+    gene_hits: dict[str, dict[str, dict]] = {}
+    patient_id = None
+    # A VCF must declare its columns in a #CHROM header line; without one the
+    # upload (e.g. a compressed or unrelated file) did not parse as VCF.
+    chrom_header_seen = False
+    # A line can only be attributed to the required gene if its name occurs
+    # somewhere in it, so one C-level scan rejects most lines before any
+    # Python-level splitting or field extraction.
+    required_gene_re = _SINGLE_GENE_NAME_RES.get(required_gene) if required_gene else None
+
+    for line in vcf_lines:
+        line = line.rstrip(b"\r\n")
+        if not line:
             continue
-        columns = line.split("\t")
+        if line[0] == 0x23:  # b"#"
+            if line.startswith(b"#CHROM"):
+                chrom_header_seen = True
+            if patient_id is None:
+                patient_id = _extract_header_patient_id(line)
+            continue
+        if required_gene_re and not required_gene_re.search(line):
+            continue
+        columns = line.split(b"\t", 8)
         if len(columns) < 8:
             continue
 
-        rsid = _extract_rsid(line, columns[2].strip())
         info = columns[7].strip()
-        combined_text = f"{line};{info}"
-        gene = _extract_gene(combined_text)
-        if not gene:
+        gene = _extract_gene(info)
+        if not gene or (required_gene and gene != required_gene):
             continue
 
-        if gene not in parsed_genes:
-            parsed_genes[gene] = {"stars": [], "rsids": []}
+        if gene not in gene_hits:
+            gene_hits[gene] = {"stars": {}, "rsids": {}}
 
-        for star in _extract_stars(combined_text):
-            if star not in parsed_genes[gene]["stars"]:
-                parsed_genes[gene]["stars"].append(star)
+        stars = gene_hits[gene]["stars"]
+        for match in _STAR_RE.finditer(info):
+            stars[match.group(0).upper()] = None
+        rsid = _extract_rsid(info, columns[2].strip())
+        if rsid:
+            gene_hits[gene]["rsids"][rsid] = None
 
-        if rsid and rsid not in parsed_genes[gene]["rsids"]:
-            parsed_genes[gene]["rsids"].append(rsid)
+    if patient_id is None:
+        patient_id = Path(filename).stem or "Unknown"
+
+    parsed_genes = {
+        gene: {
+            "stars": [star.decode("ascii") for star in hits["stars"]],
+            "rsids": list(hits["rsids"]),
+        }
+        for gene, hits in gene_hits.items()
+    }
 
     return {
         "patient_id": patient_id,
         "genes": parsed_genes,
-        "vcf_parsing_success": True,
+        "vcf_parsing_success": chrom_header_seen,
     }
 
 
 def _star_sort_key(star: str) -> tuple[int, str]:
-    match = re.match(r"\*(\d+)(.*)", star)
+    match = _STAR_SORT_RE.match(star)
     if not match:
         return (9999, star)
     return (int(match.group(1)), match.group(2))
@@ -198,7 +268,7 @@ def build_diplotype(stars: list[str]) -> str | None:
 def map_phenotype(gene: str, diplotype: str | None) -> str:
     if not diplotype:
         return "Unknown"
-    return PHENOTYPE_TABLE.get(gene, {}).get(diplotype, "Unknown")
+    return _PHENOTYPE_LOOKUP.get((gene, diplotype), "Unknown")
 
 
 def _confidence_score(gene_detected: bool, diplotype_complete: bool, rule_applied: bool) -> float:
@@ -216,65 +286,49 @@ def _unknown_recommendation(required_gene: str) -> str:
     return f"Insufficient data to apply CPIC rule for {required_gene}."
 
 
-def analyze_vcf_and_drug(vcf_bytes: bytes, filename: str, drug_name: str) -> dict:
-    try:
-        vcf_text = vcf_bytes.decode("utf-8")
-        parsed = parse_vcf(vcf_text, filename)
-    except UnicodeDecodeError:
-        parsed = {
-            "patient_id": Path(filename).stem or "Unknown",
-            "genes": {},
-            "vcf_parsing_success": False,
-        }
+def analyze_vcf_and_drug(vcf_bytes: bytes, filename: str, drug_name: str) -> AnalysisResult:
+    return analyze_vcf_stream(vcf_bytes.splitlines(), filename, drug_name)
+
 
+def analyze_vcf_stream(vcf_lines: Iterable[bytes], filename: str, drug_name: str) -> AnalysisResult:
     normalized_drug = drug_name.strip().upper()
     if normalized_drug not in CPIC_RULES:
         raise UnsupportedDrugError(f"Unsupported drug: {drug_name}")
 
-    rule_config = CPIC_RULES[normalized_drug]
-    required_gene = rule_config["gene"]
+    required_gene = CPIC_RULES[normalized_drug]["gene"]
+
+    parsed = parse_vcf(vcf_lines, filename, required_gene=required_gene)
+
     gene_data = parsed["genes"].get(required_gene)
 
     gene_detected = bool(gene_data and (gene_data["stars"] or gene_data["rsids"]))
     diplotype = build_diplotype(gene_data["stars"]) if gene_data else None
     phenotype = map_phenotype(required_gene, diplotype)
-    rule_decision = rule_config["phenotypes"].get(phenotype)
+    rule_decision = _DRUG_DECISION.get((normalized_drug, phenotype))
     rule_applied = bool(rule_decision)
 
     if rule_decision:
-        risk = rule_decision.risk
-        recommendation = rule_decision.recommendation
+        risk, recommendation, severity = rule_decision
     else:
         risk = "Unknown"
         recommendation = _unknown_recommendation(required_gene)
+        severity = SEVERITY_BY_RISK[risk]
 
     confidence_score = _confidence_score(gene_detected, bool(diplotype), rule_applied)
-    severity = SEVERITY_BY_RISK.get(risk, "moderate")
 
-    return {
-        "patient_id": parsed["patient_id"],
-        "drug": normalized_drug,
-        "gene": required_gene,
-        "diplotype": diplotype or "Unknown",
-        "phenotype": phenotype,
-        "risk": risk,
-        "recommendation": recommendation,
-        "severity": severity,
-        "confidence_score": confidence_score,
-        "rsids": gene_data["rsids"] if gene_data else [],
-        "parsed_genes": parsed["genes"],
-        "quality_metrics": {
-            "vcf_parsing_success": parsed["vcf_parsing_success"],
-            "gene_detected": gene_detected,
-            "rule_applied": rule_applied,
-            "confidence_score": confidence_score,
-        },
-        "clinical_trace": {
-            "drug_requested": normalized_drug,
-            "required_gene": required_gene,
-            "detected_diplotype": diplotype or "Unknown",
-            "derived_phenotype": phenotype,
-            "cpic_rule_applied": "Yes" if rule_applied else "No",
-            "final_risk_outcome": risk,
-        },
-    }
+    return AnalysisResult(
+        patient_id=parsed["patient_id"],
+        drug=normalized_drug,
+        gene=required_gene,
+        diplotype=diplotype or "Unknown",
+        phenotype=phenotype,
+        risk=risk,
+        recommendation=recommendation,
+        severity=severity,
+        confidence_score=confidence_score,
+        rsids=gene_data["rsids"] if gene_data else [],
+        parsed_genes=parsed["genes"],
+        vcf_parsing_success=parsed["vcf_parsing_success"],
+        gene_detected=gene_detected,
+        rule_applied=rule_applied,
+    )
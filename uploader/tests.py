@@ -1,14 +1,19 @@
+import gzip
 import tempfile
+import types
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, override_settings
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.urls import reverse
 
+from .services import gemini_client
+from .views import upload_vcf
 from .services.gemini_client import FALLBACK_EXPLANATION
-from .services.pgx_engine import UnsupportedDrugError, analyze_vcf_and_drug
+from .services.pgx_engine import UnsupportedDrugError, analyze_vcf_and_drug, parse_vcf
 
 
 def make_vcf_content(sample_id: str, variants: list[dict[str, str]]) -> bytes:
@@ -33,14 +38,25 @@ def make_vcf_content(sample_id: str, variants: list[dict[str, str]]) -> bytes:
     return ("\n".join(header + body) + "\n").encode("utf-8")
 
 
-@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+# Runs the background explanation task synchronously inside the test.
+run_explanations_inline = patch.object(
+    gemini_client._EXPLANATION_EXECUTOR,
+    "submit",
+    side_effect=lambda fn, *args, **kwargs: fn(*args, **kwargs),
+)
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
 class UploadVCFTests(TestCase):
+    def tearDown(self):
+        cache.clear()
+
     def test_valid_upload_succeeds_and_saves_file(self):
-        upload = SimpleUploadedFile(
-            "contacts.vcf",
-            b"BEGIN:VCARD\nVERSION:3.0\nFN:Jane Doe\nEND:VCARD\n",
-            content_type="text/vcard",
-        )
+        content = b"BEGIN:VCARD\nVERSION:3.0\nFN:Jane Doe\nEND:VCARD\n"
+        upload = SimpleUploadedFile("contacts.vcf", content, content_type="text/vcard")
         response = self.client.post(
             reverse("upload_vcf"),
             {"drug_name": "Codeine", "vcf_file": upload},
@@ -49,6 +65,7 @@ class UploadVCFTests(TestCase):
         self.assertContains(response, "Upload Successful")
         saved_file = Path(settings.MEDIA_ROOT) / "uploads" / "contacts.vcf"
         self.assertTrue(saved_file.exists())
+        self.assertEqual(saved_file.read_bytes(), content)
 
     def test_invalid_extension_returns_error(self):
         upload = SimpleUploadedFile("contacts.txt", b"test", content_type="text/plain")
@@ -72,6 +89,32 @@ class UploadVCFTests(TestCase):
 
         self.assertContains(response, "File size must be less than 5MB.")
 
+    def test_oversized_request_is_rejected_before_file_is_buffered(self):
+        upload = SimpleUploadedFile(
+            "huge.vcf",
+            b"a" * (6 * 1024 * 1024),
+            content_type="text/vcard",
+        )
+        with patch("django.core.files.uploadhandler.MemoryFileUploadHandler.new_file") as mock_new_file:
+            response = self.client.post(
+                reverse("upload_vcf"),
+                {"drug_name": "Codeine", "vcf_file": upload},
+            )
+
+        self.assertContains(response, "File size must be less than 5MB.")
+        self.assertNotContains(response, "Please select a .vcf file to upload.")
+        mock_new_file.assert_not_called()
+        self.assertFalse((Path(settings.MEDIA_ROOT) / "uploads" / "huge.vcf").exists())
+
+    def test_upload_still_requires_csrf_token(self):
+        upload = SimpleUploadedFile("contacts.vcf", b"test", content_type="text/vcard")
+        response = Client(enforce_csrf_checks=True).post(
+            reverse("upload_vcf"),
+            {"drug_name": "Codeine", "vcf_file": upload},
+        )
+
+        self.assertEqual(response.status_code, 403)
+
     def test_blank_drug_name_returns_error(self):
         upload = SimpleUploadedFile("contacts.vcf", b"test", content_type="text/vcard")
         response = self.client.post(
@@ -105,6 +148,7 @@ class UploadVCFTests(TestCase):
         self.assertContains(response, "*1/*4")
         self.assertContains(response, "IM")
         self.assertContains(response, "Adjust Dosage")
+        self.assertContains(response, '<span class="label">CPIC Rule Applied:</span>Yes')
 
     def test_missing_required_gene_returns_unknown_risk(self):
         vcf = make_vcf_content(
@@ -186,6 +230,91 @@ class UploadVCFTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, FALLBACK_EXPLANATION)
 
+    @patch.dict("os.environ", {"GEMINI_API_KEY": "test-key"})
+    @patch("uploader.services.gemini_client.generate_gemini_explanation", return_value="Reduced CYP2D6 activity.")
+    @run_explanations_inline
+    def test_llm_explanation_is_polled_after_upload(self, mock_submit, mock_generate):
+        vcf = make_vcf_content(
+            sample_id="PATIENT-010",
+            variants=[
+                {"rsid": "rs3892097", "gene": "CYP2D6", "star": "*1"},
+                {"rsid": "rs1065852", "gene": "CYP2D6", "star": "*4"},
+            ],
+        )
+        upload = SimpleUploadedFile("patient.vcf", vcf, content_type="text/vcard")
+
+        response = self.client.post(
+            reverse("upload_vcf"),
+            {"drug_name": "codeine", "vcf_file": upload},
+        )
+
+        self.assertContains(response, "Adjust Dosage")
+        self.assertContains(response, "Generating explanation...")
+        task_id = response.context["analysis_result"].explanation_task_id
+
+        poll_response = self.client.get(reverse("gemini_explanation", args=[task_id]))
+
+        self.assertEqual(
+            poll_response.json(),
+            {"ready": True, "explanation": "Reduced CYP2D6 activity."},
+        )
+        mock_generate.assert_called_once()
+
+    @patch.dict("os.environ", {"GEMINI_API_KEY": "test-key"})
+    @patch("uploader.services.gemini_client.generate_gemini_explanation", return_value="Explained.")
+    @patch("uploader.services.gemini_client.cache")
+    @run_explanations_inline
+    def test_explanation_is_cached_with_ttl(self, mock_submit, mock_cache, mock_generate):
+        task_id = gemini_client.submit_gemini_explanation(
+            gene="CYP2D6",
+            drug="CODEINE",
+            phenotype="IM",
+            risk="Adjust Dosage",
+            rsids=[],
+        )
+
+        mock_cache.set.assert_called_with(
+            f"gemini-explanation:{task_id}",
+            {"explanation": "Explained."},
+            gemini_client.EXPLANATION_TTL_SECONDS,
+        )
+
+    def test_pending_explanation_is_not_ready(self):
+        cache.set("gemini-explanation:pending-task", {"explanation": None})
+
+        response = self.client.get(reverse("gemini_explanation", args=["pending-task"]))
+
+        self.assertEqual(response.json(), {"ready": False, "explanation": None})
+
+    def test_unknown_explanation_task_returns_not_found(self):
+        response = self.client.get(reverse("gemini_explanation", args=["missing"]))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["explanation"], FALLBACK_EXPLANATION)
+
+    def test_responses_report_processing_time_header(self):
+        response = self.client.get(reverse("upload_vcf"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["X-Processing-Time-ms"].isdigit())
+
+    @patch.dict("os.environ", {"GEMINI_API_KEY": ""})
+    def test_upload_works_without_processing_time_middleware(self):
+        vcf = make_vcf_content(
+            sample_id="PATIENT-013",
+            variants=[{"rsid": "rs3892097", "gene": "CYP2D6", "star": "*1"}],
+        )
+        request = RequestFactory().post(
+            reverse("upload_vcf"),
+            {"drug_name": "codeine", "vcf_file": SimpleUploadedFile("patient.vcf", vcf)},
+        )
+        request._dont_enforce_csrf_checks = True
+
+        response = upload_vcf(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Processing-Time-ms", response)
+
 
 class DeterministicEngineTests(TestCase):
     def test_unsupported_drug_raises(self):
@@ -197,6 +326,18 @@ class DeterministicEngineTests(TestCase):
         with self.assertRaises(UnsupportedDrugError):
             analyze_vcf_and_drug(vcf_bytes=vcf, filename="x.vcf", drug_name="UNKNOWN_DRUG")
 
+    def test_unsupported_drug_is_rejected_before_parsing(self):
+        vcf = make_vcf_content(
+            sample_id="PATIENT-012",
+            variants=[{"rsid": "rs3892097", "gene": "CYP2D6", "star": "*1"}],
+        )
+
+        with patch("uploader.services.pgx_engine.parse_vcf") as mock_parse:
+            with self.assertRaises(UnsupportedDrugError):
+                analyze_vcf_and_drug(vcf_bytes=vcf, filename="x.vcf", drug_name="ibuprofen")
+
+        mock_parse.assert_not_called()
+
     def test_confidence_and_severity_when_rule_applies(self):
         vcf = make_vcf_content(
             sample_id="PATIENT-007",
@@ -208,9 +349,9 @@ class DeterministicEngineTests(TestCase):
 
         result = analyze_vcf_and_drug(vcf_bytes=vcf, filename="x.vcf", drug_name="CODEINE")
 
-        self.assertEqual(result["risk"], "Adjust Dosage")
-        self.assertEqual(result["confidence_score"], 1.0)
-        self.assertEqual(result["severity"], "moderate")
+        self.assertEqual(result.risk, "Adjust Dosage")
+        self.assertEqual(result.confidence_score, 1.0)
+        self.assertEqual(result.severity, "moderate")
 
     def test_confidence_and_severity_with_missing_gene(self):
         vcf = make_vcf_content(
@@ -223,6 +364,125 @@ class DeterministicEngineTests(TestCase):
 
         result = analyze_vcf_and_drug(vcf_bytes=vcf, filename="x.vcf", drug_name="CODEINE")
 
-        self.assertEqual(result["risk"], "Unknown")
-        self.assertEqual(result["confidence_score"], 0.0)
-        self.assertEqual(result["severity"], "moderate")
+        self.assertEqual(result.risk, "Unknown")
+        self.assertEqual(result.confidence_score, 0.0)
+        self.assertEqual(result.severity, "moderate")
+
+    def test_patient_id_falls_back_to_chrom_sample_column(self):
+        vcf = (
+            b"##fileformat=VCFv4.2\n"
+            b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tPATIENT-009\n"
+            b"1\t10001\trs3892097\tA\tG\t.\tPASS\tGENE=CYP2D6;STAR=*4\tGT\t0/1\n"
+        )
+
+        parsed = parse_vcf(vcf.splitlines(), "x.vcf")
+
+        self.assertEqual(parsed["patient_id"], "PATIENT-009")
+        self.assertEqual(parsed["genes"]["CYP2D6"], {"stars": ["*4"], "rsids": ["rs3892097"]})
+
+    def test_parse_vcf_skips_genes_other_than_required_gene(self):
+        vcf = make_vcf_content(
+            sample_id="PATIENT-011",
+            variants=[
+                {"rsid": "rs4244285", "gene": "CYP2C19", "star": "*2"},
+                {"rsid": "rs1065852", "gene": "CYP2D6", "star": "*4"},
+            ],
+        )
+
+        parsed = parse_vcf(vcf.splitlines(), "x.vcf", required_gene="CYP2D6")
+
+        self.assertEqual(list(parsed["genes"]), ["CYP2D6"])
+
+    def test_rsid_fallback_ignores_sample_columns(self):
+        vcf = (
+            b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n"
+            b"1\t10001\t.\tA\tG\t.\tPASS\tGENE=CYP2D6;STAR=*4\tGT:NOTE\t0/1:rs999\n"
+            b"1\t10002\t.\tA\tG\t.\tPASS\tGENE=CYP2D6;STAR=*1;RS=RS1065852\tGT\t0/1\n"
+            b"1\t10003\tCOSV1;rs456\tA\tG\t.\tPASS\tGENE=CYP2D6;RS=rs777\tGT\t0/1\n"
+            b"1\t10004\tRS9\tA\tG\t.\tPASS\tGENE=CYP2D6\tGT\t0/1\n"
+        )
+
+        parsed = parse_vcf(vcf.splitlines(), "x.vcf")
+
+        self.assertEqual(parsed["genes"]["CYP2D6"]["rsids"], ["rs1065852", "rs456", "rs9"])
+
+    def test_gene_name_fallback_follows_supported_gene_order(self):
+        vcf = (
+            b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n"
+            b"1\t10001\trs3892097\tA\tG\t.\tPASS\tANN=CYP2C19,CYP2D6;STAR=*1\tGT\t0/1\n"
+            b"1\t10002\trs1065852\tA\tG\t.\tPASS\tANN=CYP2C19,CYP2D6;STAR=*4\tGT\t0/1\n"
+        )
+
+        result = analyze_vcf_and_drug(vcf_bytes=vcf, filename="x.vcf", drug_name="CODEINE")
+
+        self.assertEqual(result.diplotype, "*1/*4")
+        self.assertEqual(result.risk, "Adjust Dosage")
+
+    def test_non_vcf_upload_reports_parsing_failure(self):
+        vcf = make_vcf_content(
+            sample_id="PATIENT-014",
+            variants=[{"rsid": "rs3892097", "gene": "CYP2D6", "star": "*1"}],
+        )
+
+        plain_result = analyze_vcf_and_drug(vcf_bytes=vcf, filename="x.vcf", drug_name="CODEINE")
+        gzip_result = analyze_vcf_and_drug(
+            vcf_bytes=gzip.compress(vcf),
+            filename="x.vcf",
+            drug_name="CODEINE",
+        )
+
+        self.assertTrue(plain_result.vcf_parsing_success)
+        self.assertFalse(gzip_result.vcf_parsing_success)
+        self.assertEqual(gzip_result.patient_id, "x")
+
+    def test_repeated_info_gene_key_uses_first_value(self):
+        vcf = (
+            b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n"
+            b"1\t10001\trs3892097\tA\tG\t.\tPASS\tGENE=CYP2D6;STAR=*4;GENE=CYP2C19\tGT\t0/1\n"
+        )
+
+        parsed = parse_vcf(vcf.splitlines(), "x.vcf")
+
+        self.assertEqual(list(parsed["genes"]), ["CYP2D6"])
+
+
+class GeminiClientTests(TestCase):
+    def setUp(self):
+        gemini_client._get_model.cache_clear()
+        self.addCleanup(gemini_client._get_model.cache_clear)
+
+    @patch.dict("os.environ", {"GEMINI_API_KEY": "test-key"})
+    def test_model_is_configured_once_per_key_and_model(self):
+        genai = MagicMock()
+        genai.GenerativeModel.return_value.generate_content.return_value.text = "Explained."
+        google = types.ModuleType("google")
+        google.generativeai = genai
+
+        with patch.dict("sys.modules", {"google": google, "google.generativeai": genai}):
+            explanations = [
+                gemini_client.generate_gemini_explanation(
+                    gene="CYP2D6",
+                    drug="CODEINE",
+                    phenotype="IM",
+                    risk="Adjust Dosage",
+                    rsids=[],
+                )
+                for _ in range(2)
+            ]
+
+        self.assertEqual(explanations, ["Explained.", "Explained."])
+        genai.configure.assert_called_once_with(api_key="test-key")
+        genai.GenerativeModel.assert_called_once()
+
+    @patch.dict("os.environ", {"GEMINI_API_KEY": "test-key"})
+    def test_missing_sdk_returns_fallback_explanation(self):
+        with patch.dict("sys.modules", {"google.generativeai": None}):
+            explanation = gemini_client.generate_gemini_explanation(
+                gene="CYP2D6",
+                drug="CODEINE",
+                phenotype="IM",
+                risk="Adjust Dosage",
+                rsids=[],
+            )
+
+        self.assertEqual(explanation, FALLBACK_EXPLANATION)
@@ -0,0 +1,22 @@
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from .forms import MAX_UPLOAD_REQUEST_BYTES
+
+
+# Installed by the upload view ahead of Django's memory/temp-file handlers so an
+# oversized request is stopped before any of its file data is buffered.
+class VCFSizeLimitUploadHandler(FileUploadHandler):
+    upload_too_large = False
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.upload_too_large = content_length > MAX_UPLOAD_REQUEST_BYTES
+
+    def new_file(self, *args, **kwargs):
+        if self.upload_too_large:
+            raise StopUpload()
+
+    def receive_data_chunk(self, raw_data, start):
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
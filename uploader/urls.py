@@ -1,7 +1,8 @@
 from django.urls import path
 
-from .views import upload_vcf
+from .views import gemini_explanation, upload_vcf
 
 urlpatterns = [
     path("", upload_vcf, name="upload_vcf"),
+    path("explanations/<str:task_id>/", gemini_explanation, name="gemini_explanation"),
 ]
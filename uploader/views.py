@@ -1,34 +1,51 @@
 from pathlib import Path
-from time import perf_counter
 
 from django.core.files.storage import default_storage
+from django.http import JsonResponse
 from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
 from .forms import VCFUploadForm
-from .services.gemini_client import generate_gemini_explanation
-from .services.pgx_engine import UnsupportedDrugError, analyze_vcf_and_drug
+from .middleware import processing_time_ms
+from .services.gemini_client import (
+    FALLBACK_EXPLANATION,
+    poll_gemini_explanation,
+    submit_gemini_explanation,
+)
+from .services.pgx_engine import UnsupportedDrugError, analyze_vcf_stream
+from .upload_handlers import VCFSizeLimitUploadHandler
 
 
+# The size-limit handler has to be installed before CSRF checking reads
+# request.POST, so CSRF protection is applied inside the wrapper instead.
+@csrf_exempt
 def upload_vcf(request):
+    size_limit_handler = VCFSizeLimitUploadHandler(request)
+    request.upload_handlers.insert(0, size_limit_handler)
+    return _upload_vcf(request, size_limit_handler)
+
+
+@csrf_protect
+def _upload_vcf(request, size_limit_handler):
     success_message = None
     saved_path = None
     analysis_result = None
 
     if request.method == "POST":
-        form = VCFUploadForm(request.POST, request.FILES)
+        post_data, files = request.POST, request.FILES
+        form = VCFUploadForm(
+            post_data,
+            files,
+            upload_too_large=size_limit_handler.upload_too_large,
+        )
         if form.is_valid():
             uploaded_file = form.cleaned_data["vcf_file"]
             drug_name = form.cleaned_data["drug_name"]
             safe_name = Path(uploaded_file.name).name
-            saved_path = default_storage.save(f"uploads/{safe_name}", uploaded_file)
 
-            with default_storage.open(saved_path, "rb") as file_handle:
-                vcf_bytes = file_handle.read()
-
-            started_at = perf_counter()
             try:
-                analysis_result = analyze_vcf_and_drug(
-                    vcf_bytes=vcf_bytes,
+                analysis_result = analyze_vcf_stream(
+                    vcf_lines=uploaded_file,
                     filename=safe_name,
                     drug_name=drug_name,
                 )
@@ -46,22 +63,28 @@ def upload_vcf(request):
                     status=400,
                 )
 
-            processing_time_ms = int((perf_counter() - started_at) * 1000)
-            analysis_result["quality_metrics"]["processing_time_ms"] = processing_time_ms
+            saved_path = default_storage.save(f"uploads/{safe_name}", uploaded_file)
 
-            analysis_result["explanation"] = generate_gemini_explanation(
-                gene=analysis_result["gene"],
-                drug=analysis_result["drug"],
-                phenotype=analysis_result["phenotype"],
-                risk=analysis_result["risk"],
-                rsids=analysis_result["rsids"],
+            explanation_task_id = submit_gemini_explanation(
+                gene=analysis_result.gene,
+                drug=analysis_result.drug,
+                phenotype=analysis_result.phenotype,
+                risk=analysis_result.risk,
+                rsids=analysis_result.rsids,
             )
+            if explanation_task_id:
+                analysis_result.explanation_task_id = explanation_task_id
+            else:
+                analysis_result.explanation = FALLBACK_EXPLANATION
 
             success_message = "Upload Successful"
             form = VCFUploadForm(initial={"drug_name": drug_name})
     else:
         form = VCFUploadForm()
 
+    if analysis_result is not None:
+        analysis_result.processing_time_ms = processing_time_ms(request)
+
     return render(
         request,
         "uploader/upload.html",
@@ -70,5 +93,15 @@ def upload_vcf(request):
             "success_message": success_message,
             "saved_path": saved_path,
             "analysis_result": analysis_result,
+            "fallback_explanation": FALLBACK_EXPLANATION,
         },
     )
+
+
+def gemini_explanation(request, task_id):
+    try:
+        explanation = poll_gemini_explanation(task_id)
+    except KeyError:
+        return JsonResponse({"ready": True, "explanation": FALLBACK_EXPLANATION}, status=404)
+
+    return JsonResponse({"ready": explanation is not None, "explanation": explanation})